@@ -0,0 +1,261 @@
+"""
+Shared extraction and comparison helpers for the forensics app.
+Everything here is a plain function of its inputs, so the Streamlit
+layer can cache and parallelise it freely.
+"""
+import zipfile
+import os
+import re
+import sys
+import cv2
+import numpy as np
+from blake3 import blake3
+
+try:
+    from orjson import loads as json_loads
+except ImportError: # Slower, but parses the same bytes
+    from json import loads as json_loads
+
+try:
+    from numba import njit # Kernels use cache=True so compiled code survives app restarts in __pycache__
+except ImportError: # Optional: the NumPy and OpenCV paths below are used instead
+    njit = None
+
+# Part of the app's on-disk cache keys: bump whenever extract_project_logic or
+# get_image_fingerprint would return something different for the same file
+EXTRACT_VERSION = 2
+
+# --- HASHING ---
+# Buffers this big are hashed on several cores; smaller ones already run inside the ingest pool
+_THREADED_HASH_MIN = 16 << 20
+
+def get_file_hash(file_obj):
+    # Accepts bytes already in hand, or streams a file through the hash instead of materialising it.
+    # Only used for equality checks, so the SIMD BLAKE3 beats MD5 here and 128 bits is plenty.
+    if isinstance(file_obj, bytes):
+        return blake3(file_obj).hexdigest(length=16)
+    if hasattr(file_obj, 'getvalue'):
+        # A BytesIO built from bytes hands those same bytes back from getvalue(), whereas getbuffer()
+        # would unshare and copy them
+        data = file_obj.getvalue()
+        threads = blake3.AUTO if len(data) >= _THREADED_HASH_MIN else 1
+        return blake3(data, max_threads=threads).hexdigest(length=16)
+    # Zip members (videos included) are inflated and hashed 1 MiB at a time on the calling thread;
+    # chunks that small gain little from BLAKE3's own threads
+    h = blake3()
+    for chunk in iter(lambda: file_obj.read(1 << 20), b''):
+        h.update(chunk)
+    return h.hexdigest(length=16)
+
+# --- POSTERS ---
+def get_image_fingerprint(image_bytes):
+    """
+    Colour histogram and perceptual hash of one poster, from a single decode.
+    Returns: (Histogram, pHash) or (None, None) if the image is unreadable
+    """
+    try:
+        file_bytes = np.frombuffer(image_bytes, dtype=np.uint8) # A view, not a copy
+        # The 512-bin histogram is normalised, so a quarter-scale decode gives the same shape of
+        # distribution for a sixteenth of the decode and calcHist work (libjpeg scales in its IDCT)
+        image = cv2.imdecode(file_bytes, cv2.IMREAD_REDUCED_COLOR_4)
+        if njit is not None:
+            hist = _color_histogram(image)
+        else:
+            hist = cv2.calcHist([image], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256]).flatten()
+        # Centre and scale once here so HISTCMP_CORREL between two posters is a plain dot product
+        hist -= hist.mean()
+        norm = np.linalg.norm(hist)
+        return (hist / norm if norm else hist), _perceptual_hash(image)
+    except:
+        return None, None
+
+def _perceptual_hash(image):
+    # pHash: one bit per low-frequency DCT coefficient of a 32x32 grey thumbnail, set when above the median.
+    # It follows layout rather than colour, so a recoloured copy still lands close.
+    grey = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(np.float32(grey))[:8, :8]
+    return int.from_bytes(np.packbits(low > np.median(low)).tobytes(), 'big')
+
+if njit is not None:
+    @njit(cache=True)
+    def _color_histogram(image):
+        # Same bins as calcHist's uniform 8x8x8 over BGR, with the 512 counters kept in L1
+        hist = np.zeros(512, np.float32)
+        h, w, _ = image.shape
+        for y in range(h):
+            for x in range(w):
+                px = image[y, x]
+                hist[((px[0] >> 5) << 6) | ((px[1] >> 5) << 3) | (px[2] >> 5)] += 1.0
+        return hist
+
+def histogram_correlation(hists):
+    """
+    Pairwise HISTCMP_CORREL for a stack of histograms from get_image_fingerprint.
+    Returns: (N, N) matrix of correlations
+    """
+    h = np.stack(hists)
+    return h @ h.T
+
+def phash_similarity(phashes):
+    """
+    Pairwise share of matching bits between 64-bit perceptual hashes,
+    as one broadcast XOR and popcount.
+    Returns: (N, N) matrix in [0, 1]
+    """
+    h = np.array(phashes, dtype=np.uint64)
+    diff = h[:, None] ^ h[None, :]
+    if hasattr(np, 'bitwise_count'): # NumPy 2.0+
+        dist = np.bitwise_count(diff)
+    else:
+        dist = np.unpackbits(diff[..., None].view(np.uint8), axis=-1).sum(axis=-1)
+    return 1 - dist / 64
+
+# --- PROJECTS ---
+def extract_project_logic(file_bytes):
+    """
+    Reads .sb3 and .p3b files properly.
+    Returns: (Opcode Sequence, Asset Hashes, Sprite Count)
+    """
+    logic = []
+    assets = set()
+    sprite_count = 0
+    
+    try:
+        with zipfile.ZipFile(file_bytes) as z:
+            # 1. Get Assets, spotting project.json in the same walk over the directory
+            project_info = None
+            for info in z.infolist():
+                if info.filename == 'project.json':
+                    project_info = info
+                    continue
+                with z.open(info) as fp:
+                    assets.add(get_file_hash(fp))
+            
+            # 2. Get Logic (project.json)
+            if project_info is not None:
+                data = json_loads(z.read(project_info))
+                targets = sorted(data.get('targets', []), key=lambda x: x.get('name', '')) # Sort sprites
+                sprite_count = len(targets)
+                # Hot loop over every block: bind lookups locally
+                append, extend, _isinstance, _dict, _intern = logic.append, logic.extend, isinstance, dict, sys.intern
+                
+                for target in targets:
+                    blocks = target.get('blocks', {})
+                    # Handle both Dict and List formats (Pictoblox sometimes uses Lists)
+                    if _isinstance(blocks, _dict):
+                        blocks = blocks.values()
+                    elif not _isinstance(blocks, list): # Rare case
+                        continue
+                    # Interned, so vocabulary lookups and sequence equality hit the identity fast path.
+                    # Nearly every block has a string opcode, so one comprehension per sprite is tried first
+                    try:
+                        extend([_intern(block['opcode']) for block in blocks
+                                if _isinstance(block, _dict) and not block.get('shadow')])
+                        continue
+                    except (KeyError, TypeError):
+                        pass
+                    # A malformed block somewhere in this sprite: redo it one block at a time
+                    for block in blocks:
+                        if not _isinstance(block, _dict) or block.get('shadow'): continue
+                        try:
+                            append(_intern(block['opcode']))
+                        except (KeyError, TypeError):
+                            append('unknown')
+                                
+    except Exception as e:
+        return None, None, 0 # File is corrupt or not a zip
+        
+    return tuple(logic), assets, sprite_count
+
+def encode_logic(logics):
+    """
+    Maps opcode sequences onto one shared integer vocabulary so they
+    are compared token by token instead of character by character.
+    Returns: (Token Sequences, Opcode Count Matrix)
+    """
+    vocab = {}
+    seqs = [np.fromiter((vocab.setdefault(op, len(vocab)) for op in logic), dtype=np.int32, count=len(logic))
+            for logic in logics]
+    counts = np.stack([np.bincount(seq, minlength=len(vocab)) for seq in seqs])
+    # A class rarely uses more than 256 distinct opcodes; as bytes, RapidFuzz's bit-parallel
+    # LCS indexes its pattern table directly instead of hashing every token
+    if len(vocab) <= 256:
+        seqs = [seq.astype(np.uint8).tobytes() for seq in seqs]
+    return seqs, counts
+
+def overlap_bounds(counts, floor=0.0):
+    """
+    Upper bound on every pair's InDel ratio, from an opcode count matrix.
+    Two sequences can only have as many opcodes in common as their
+    multisets share, so 2 * |A ∩ B| / (|A| + |B|) is never below the
+    real score (it is difflib's quick_ratio).
+    Since min(a, b) <= sqrt(a * b), one matrix product over square-rooted
+    counts bounds every pair at once; the exact overlap is only taken
+    where that looser bound reaches floor.
+    Returns: (N, N) matrix of bounds in [0, 1]
+    """
+    lens = counts.sum(axis=1)
+    total = lens[:, None] + lens[None, :]
+    roots = np.sqrt(counts)
+    bounds = 2 * (roots @ roots.T) / total
+    # Slack for rounding in the square roots, so a pair sitting exactly on floor is never dropped
+    keep = bounds >= floor - 1e-9
+    if njit is not None:
+        shared = _shared_counts(counts, keep)
+    else:
+        shared = np.zeros((len(counts), len(counts)))
+        for i, row in enumerate(counts):
+            cols = np.flatnonzero(keep[i])
+            shared[i, cols] = np.minimum(row, counts[cols]).sum(axis=1)
+    return np.where(keep, 2 * shared / total, bounds)
+
+if njit is not None:
+    @njit(cache=True)
+    def _shared_counts(counts, keep):
+        # Fused min-and-sum over one triangle: no (N, V) temporary per row
+        n, v = counts.shape
+        shared = np.zeros((n, n))
+        for i in range(n):
+            row = counts[i]
+            for j in range(i, n):
+                if not keep[i, j]: continue
+                s = 0
+                other = counts[j]
+                for k in range(v):
+                    s += min(row[k], other[k])
+                shared[i, j] = shared[j, i] = s
+        return shared
+
+def encode_assets(asset_sets):
+    """
+    Packs each project's asset hashes into an int bitset over one shared
+    index, so a pair's shared-asset count is a single AND + popcount.
+    Returns: [Bitset]
+    """
+    index = {}
+    masks = []
+    for assets in asset_sets:
+        mask = 0
+        for h in assets:
+            mask |= 1 << index.setdefault(h, len(index))
+        masks.append(mask)
+    return masks
+
+# --- NAMING ---
+_PATH_SEP = re.compile(r'[\\/]')
+
+def extract_student_name(filename):
+    """
+    Folder-Aware Naming.
+    Zip Path: "Class 9A/Midhun/Game.sb3" -> Returns "Midhun"
+    """
+    parts = [p for p in _PATH_SEP.split(filename) if "__MACOSX" not in p and p != "." and p]
+    
+    if len(parts) > 1:
+        # Check parent folder
+        folder = parts[-2]
+        if folder.lower() not in ['images', 'sounds', 'project', 'src']:
+            return folder
+            
+    # Fallback to filename
+    return os.path.splitext(parts[-1])[0].replace("_", " ").title()
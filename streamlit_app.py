@@ -1,14 +1,15 @@
 import streamlit as st
 import zipfile
-import json
-import hashlib
-import difflib
 import io
 import os
-import cv2
 import numpy as np
-from PIL import Image
-from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
+from forensics import (
+    EXTRACT_VERSION, get_file_hash, get_image_fingerprint, histogram_correlation, phash_similarity,
+    extract_project_logic, encode_logic, overlap_bounds, encode_assets, extract_student_name,
+)
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="KITE Forensics Master", page_icon="🛡️", layout="wide")
@@ -32,76 +33,160 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# --- 3. CORE LOGIC EXTRACTOR (THE FIX) ---
-def get_file_hash(bytes_data):
-    return hashlib.md5(bytes_data).hexdigest()
+# --- 3. FILE INGESTION ---
+# Sliders rerun the whole script; keyed on the content hash, only new files get unpacked again.
+# The hash is always taken before extraction, and Streamlit computes each key once even across
+# worker threads, so exact copies in one batch share a single parse.
+# persist="disk" keeps the results across server restarts, so re-marking last week's
+# submissions skips extraction entirely. Disk entries are never evicted and the key does
+# not cover forensics.py, so EXTRACT_VERSION is passed in to retire stale results.
+@st.cache_data(show_spinner=False, max_entries=256, persist="disk")
+def load_project(file_hash, version, _file_obj):
+    return extract_project_logic(_file_obj)
+
+@st.cache_data(show_spinner=False, max_entries=1024, persist="disk")
+def load_fingerprint(file_hash, version, _data):
+    return get_image_fingerprint(_data)
+
+PROJECT_EXTS = {'sb3', 'p3b'}
+IMAGE_EXTS = {'jpg', 'png', 'jpeg'}
+VIDEO_EXTS = {'mp4', 'mkv'}
+ALLOWED_EXTS = PROJECT_EXTS | IMAGE_EXTS | VIDEO_EXTS
+
+def scan_upload(up_file):
+    """
+    Lists the members of one uploaded file (class zip or single file) worth analysing.
+    Only the zip's central directory is read here; nothing is inflated yet.
+    Returns: ([(Upload, Zip or None, ZipInfo or None, Owner, Extension)], Error Message or None)
+    """
+    items = []
 
-def get_image_histogram(image_bytes):
+    # --- ZIP HANDLING ---
+    if up_file.name.endswith(".zip"):
+        try:
+            z = zipfile.ZipFile(up_file)
+        except:
+            return items, f"Error reading zip: {up_file.name}"
+        for info in z.infolist():
+            filename = info.filename
+            if info.is_dir() or info.file_size == 0 or filename.startswith("."): continue
+            if "__MACOSX" in filename: continue
+
+            ext = filename.rpartition('.')[2].lower()
+            if ext not in ALLOWED_EXTS: continue
+            items.append((up_file, z, info, extract_student_name(filename), ext))
+
+    # --- SINGLE FILE HANDLING ---
+    else:
+        owner = os.path.splitext(up_file.name)[0].replace("_", " ").title()
+        ext = up_file.name.rpartition('.')[2].lower()
+        if ext in PROJECT_EXTS | IMAGE_EXTS:
+            items.append((up_file, None, None, owner, ext))
+
+    return items, None
+
+def process_member(up_file, z, info, owner, ext):
+    """
+    Hashes and extracts one project, poster or video.
+    Runs on a worker thread, so it must not call Streamlit itself;
+    ZipFile reads are safe to share between threads.
+    Returns: ((Kind, Owner, Record) or None, Error Message or None)
+    """
     try:
-        file_bytes = np.asarray(bytearray(image_bytes.read()), dtype=np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        hist = cv2.calcHist([image], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-        cv2.normalize(hist, hist)
-        return hist.flatten()
+        # LOGIC: Projects
+        if ext in PROJECT_EXTS:
+            if z is None:
+                up_file.seek(0)
+                raw = up_file
+            else:
+                raw = io.BytesIO(z.read(info))
+            file_hash = get_file_hash(raw)
+            l, a, s = load_project(file_hash, EXTRACT_VERSION, raw)
+            if l:
+                return ('project', owner, {'hash': file_hash, 'logic': l, 'assets': a, 'sprites': s}), None
+
+        # LOGIC: Images
+        elif ext in IMAGE_EXTS:
+            # One read feeds the hash and the decoder; the bytes are dropped afterwards
+            data = up_file.getvalue() if z is None else z.read(info)
+            hist, phash = load_fingerprint(get_file_hash(data), EXTRACT_VERSION, data)
+            if hist is not None:
+                return ('image', owner, {'hist': hist, 'phash': phash, 'src': (z or up_file, info)}), None
+
+        # LOGIC: Videos
+        elif ext in VIDEO_EXTS:
+            with z.open(info) as fp:
+                video_hash = get_file_hash(fp)
+            return ('video', owner, {'hash': video_hash, 'size': info.file_size}), None
+
     except:
-        return None
+        return None, f"Error reading {'file' if z is None else 'zip'}: {up_file.name}"
+    return None, None
+
+def read_image(src):
+    # Posters are only kept as a pointer into their upload and re-read when a match is shown.
+    # Zip members point at the ZipFile opened by scan_upload, so its directory is parsed once
+    source, info = src
+    if info is None: return source.getvalue()
+    return source.read(info)
 
-def extract_project_logic(file_bytes):
+def ingest_uploads(uploaded_files):
     """
-    Reads .sb3 and .p3b files properly.
-    Returns: (Logic String, Asset Hashes, Sprite Count)
+    Unpacks a whole set of uploads.
+    Returns: (Projects, Images, Videos, [Error Message])
     """
-    logic = []
-    assets = set()
-    sprite_count = 0
-    
-    try:
-        with zipfile.ZipFile(file_bytes) as z:
-            # 1. Get Assets
-            for f in z.namelist():
-                if f != 'project.json':
-                    assets.add(hashlib.md5(z.read(f)).hexdigest())
-            
-            # 2. Get Logic (project.json)
-            if 'project.json' in z.namelist():
-                data = json.loads(z.read('project.json'))
-                targets = data.get('targets', [])
-                targets.sort(key=lambda x: x.get('name', '')) # Sort sprites
-                sprite_count = len(targets)
-                
-                for target in targets:
-                    blocks = target.get('blocks', {})
-                    # Handle both Dict and List formats (Pictoblox sometimes uses Lists)
-                    if isinstance(blocks, dict):
-                        for block in blocks.values():
-                            if isinstance(block, dict) and not block.get('shadow'):
-                                logic.append(block.get('opcode', 'unknown'))
-                    elif isinstance(blocks, list): # Rare case
-                        for block in blocks:
-                            if isinstance(block, dict) and not block.get('shadow'):
-                                logic.append(block.get('opcode', 'unknown'))
-                                
-    except Exception as e:
-        return None, None, 0 # File is corrupt or not a zip
-        
-    return "\n".join(logic), assets, sprite_count
-
-def extract_student_name(filename):
+    projects = {}
+    images = {}
+    videos = {}
+    errors = []
+    items = []
+    for up_file in uploaded_files:
+        found, error = scan_upload(up_file)
+        if error: errors.append(error)
+        items += found
+
+    # Inflating, hashing and decoding release the GIL, so every member of every upload,
+    # even a single class zip, is unpacked side by side
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        results = list(pool.map(lambda item: process_member(*item), items))
+
+    # Merge in upload order so duplicate owners get the same suffixes every run
+    buckets = {'project': projects, 'image': images, 'video': videos}
+    for entry, error in results:
+        if error and error not in errors: errors.append(error)
+        if entry:
+            kind, owner, record = entry
+            bucket = buckets[kind]
+            if owner in bucket: owner += f" ({len(bucket)+1})"
+            bucket[owner] = record
+    return projects, images, videos, errors
+
+# Lowest value of the code slider: pairs are scored down to here once, so moving the slider only re-filters
+CODE_FLOOR = 70
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def score_projects(rep_hashes, _logics):
     """
-    Folder-Aware Naming.
-    Zip Path: "Class 9A/Midhun/Game.sb3" -> Returns "Midhun"
+    Scores every pair of distinct projects that could reach CODE_FLOOR.
+    Keyed on the hashes of the projects being compared, one per group of exact copies.
+    Returns: [(Index A, Index B, Similarity)]
     """
-    path = filename.replace("\\", "/")
-    parts = [p for p in path.split("/") if "__MACOSX" not in p and p != "." and p]
-    
-    if len(parts) > 1:
-        # Check parent folder
-        folder = parts[-2]
-        if folder.lower() not in ['images', 'sounds', 'project', 'src']:
-            return folder
-            
-    # Fallback to filename
-    return os.path.splitext(parts[-1])[0].replace("_", " ").title()
+    seqs, counts = encode_logic(_logics)
+    bounds = overlap_bounds(counts, CODE_FLOOR / 100) * 100
+    identical, candidates = [], []
+    # Logic Match: only pairs whose shared opcodes could still clear the floor
+    for a, b in zip(*np.nonzero(np.triu(bounds > CODE_FLOOR, 1))):
+        # Equal opcode multisets may just be the same script with sprites renamed: no scoring needed
+        if bounds[a, b] == 100 and _logics[a] == _logics[b]:
+            identical.append((a, b))
+        else:
+            candidates.append((a, b))
+
+    # Score every surviving pair in one multi-threaded native call
+    sims = process.cpdist([seqs[a] for a, _ in candidates], [seqs[b] for _, b in candidates],
+                          scorer=Indel.normalized_similarity, workers=-1) * 100
+    return [(a, b, 100.0) for a, b in identical] + \
+           [(a, b, float(sim)) for (a, b), sim in zip(candidates, sims) if sim > CODE_FLOOR]
 
 # --- 4. SIDEBAR ---
 with st.sidebar:
@@ -111,8 +196,10 @@ with st.sidebar:
     st.markdown("---")
     st.info("**Developed by Midhun T V**\nMaster Trainer\nKITE Kasaragod")
     st.markdown("---")
-    code_thresh = st.slider("Code Logic Match", 70, 100, 85, format="%d%%")
+    code_thresh = st.slider("Code Logic Match", CODE_FLOOR, 100, 85, format="%d%%")
     img_thresh = st.slider("Visual Match", 50, 100, 80, format="%d%%")
+    # Unrelated posters already agree on about half their pHash bits, so this one starts higher
+    layout_thresh = st.slider("Layout Match", 75, 100, 90, format="%d%%")
 
 # --- 5. MAIN INTERFACE ---
 st.title("🛡️ Little KITES Forensics Suite")
@@ -125,65 +212,17 @@ uploaded_files = st.file_uploader(
 )
 
 if uploaded_files:
-    projects = {}
-    images = {}
-    videos = {}
-    
-    with st.spinner("Processing Files..."):
-        for up_file in uploaded_files:
-            
-            # --- ZIP HANDLING ---
-            if up_file.name.endswith(".zip"):
-                try:
-                    with zipfile.ZipFile(up_file) as z:
-                        for filename in z.namelist():
-                            if filename.startswith(".") or filename.endswith("/"): continue
-                            if "__MACOSX" in filename: continue
-                            
-                            owner = extract_student_name(filename)
-                            ext = filename.split('.')[-1].lower()
-                            
-                            # LOGIC: Projects
-                            if ext in ['sb3', 'p3b']:
-                                raw = io.BytesIO(z.read(filename))
-                                l, a, s = extract_project_logic(raw)
-                                if l: 
-                                    if owner in projects: owner += f" ({len(projects)+1})"
-                                    projects[owner] = {'hash': get_file_hash(raw.getvalue()), 'logic': l, 'sprites': s}
-                            
-                            # LOGIC: Images
-                            elif ext in ['jpg', 'png', 'jpeg']:
-                                raw = io.BytesIO(z.read(filename))
-                                raw.seek(0)
-                                hist = get_image_histogram(raw)
-                                if hist is not None:
-                                    raw.seek(0)
-                                    if owner in images: owner += f" ({len(images)+1})"
-                                    images[owner] = {'hist': hist, 'obj': raw}
-                            
-                            # LOGIC: Videos
-                            elif ext in ['mp4', 'mkv']:
-                                raw_bytes = z.read(filename)
-                                if owner in videos: owner += f" ({len(videos)+1})"
-                                videos[owner] = {'hash': get_file_hash(raw_bytes), 'size': len(raw_bytes)}
-
-                except:
-                    st.error(f"Error reading zip: {up_file.name}")
-
-            # --- SINGLE FILE HANDLING ---
-            else:
-                up_file.seek(0)
-                owner = os.path.splitext(up_file.name)[0].replace("_", " ").title()
-                ext = up_file.name.split('.')[-1].lower()
-                
-                if ext in ['sb3', 'p3b']:
-                    l, a, s = extract_project_logic(up_file)
-                    if l: projects[owner] = {'hash': get_file_hash(up_file.getvalue()), 'logic': l, 'sprites': s}
-                elif ext in ['jpg', 'png']:
-                    hist = get_image_histogram(up_file)
-                    if hist is not None:
-                        up_file.seek(0)
-                        images[owner] = {'hist': hist, 'obj': up_file}
+    # The per-file caches still need every member inflated and hashed to find their key;
+    # keyed on Streamlit's upload ids, a slider rerun skips even that. Kept in session state,
+    # so the records (which point into the uploads) are dropped by a new set, a cleared uploader
+    # or the end of the session.
+    upload_ids = tuple(f.file_id for f in uploaded_files)
+    if st.session_state.get('upload_ids') != upload_ids:
+        with st.spinner("Processing Files..."):
+            st.session_state['ingested'] = ingest_uploads(uploaded_files)
+        st.session_state['upload_ids'] = upload_ids
+    projects, images, videos, errors = st.session_state['ingested']
+    for error in errors: st.error(error)
 
     # --- RESULTS DASHBOARD ---
     c1, c2, c3 = st.columns(3)
@@ -198,31 +237,43 @@ if uploaded_files:
         if len(projects) < 2:
             st.warning("Needs at least 2 .sb3/.p3b files to compare.")
         else:
-            pairs = list(combinations(projects.keys(), 2))
-            found = False
-            for p1, p2 in pairs:
+            keys = list(projects.keys())
+            hashes = [projects[k]['hash'] for k in keys]
+            asset_masks = encode_assets([projects[k]['assets'] for k in keys])
+
+            # Binary Match: group by hash, so exact copies are found in one pass and scored only once
+            groups = {}
+            for i, h in enumerate(hashes): groups.setdefault(h, []).append(i)
+            members = list(groups.values())
+            exact = sorted((g[a], g[b]) for g in members for a in range(len(g)) for b in range(a + 1, len(g)))
+
+            logics = [projects[keys[g[0]]]['logic'] for g in members]
+            scored = [(a, b, sim) for a, b, sim in score_projects(tuple(hashes[g[0]] for g in members), logics)
+                      if sim > code_thresh]
+            # Every copy in a group shares its representative's score
+            matches = sorted((min(i, j), max(i, j), sim) for a, b, sim in scored
+                             for i in members[a] for j in members[b])
+
+            found = bool(exact)
+            for i, j in exact:
+                st.markdown(f"""
+                <div class="report-card">
+                    <h4>🚨 EXACT COPY DETECTED</h4>
+                    <span class="student-tag">{keys[i]}</span> is identical to <span class="student-tag">{keys[j]}</span>
+                </div>""", unsafe_allow_html=True)
+
+            for i, j, sim in matches:
+                found = True
+                p1, p2 = keys[i], keys[j]
                 d1, d2 = projects[p1], projects[p2]
-                
-                # Binary Match
-                if d1['hash'] == d2['hash']:
-                    st.markdown(f"""
-                    <div class="report-card">
-                        <h4>🚨 EXACT COPY DETECTED</h4>
-                        <span class="student-tag">{p1}</span> is identical to <span class="student-tag">{p2}</span>
-                    </div>""", unsafe_allow_html=True)
-                    found = True
-                    continue
-
-                # Logic Match
-                sim = difflib.SequenceMatcher(None, d1['logic'], d2['logic']).ratio() * 100
-                if sim > code_thresh:
-                    found = True
-                    st.markdown(f"""
-                    <div class="report-card">
-                        <h4>⚠️ High Code Similarity: {sim:.1f}%</h4>
-                        <span class="student-tag">{p1}</span> vs <span class="student-tag">{p2}</span>
-                        <br><br><b>Sprite Count:</b> {d1['sprites']} vs {d2['sprites']}
-                    </div>""", unsafe_allow_html=True)
+                shared = (asset_masks[i] & asset_masks[j]).bit_count()
+                st.markdown(f"""
+                <div class="report-card">
+                    <h4>⚠️ High Code Similarity: {sim:.1f}%</h4>
+                    <span class="student-tag">{p1}</span> vs <span class="student-tag">{p2}</span>
+                    <br><br><b>Sprite Count:</b> {d1['sprites']} vs {d2['sprites']}
+                    <br><b>Shared Assets:</b> {shared}
+                </div>""", unsafe_allow_html=True)
             
             if not found: st.success("✅ No code plagiarism detected.")
 
@@ -230,36 +281,49 @@ if uploaded_files:
     with tab2:
         if len(images) < 2: st.info("Needs 2+ images.")
         else:
-            pairs = list(combinations(images.keys(), 2))
+            keys = list(images.keys())
+            sims = histogram_correlation([images[k]['hist'] for k in keys]) * 100
+            layouts = phash_similarity([images[k]['phash'] for k in keys]) * 100
             found = False
-            for p1, p2 in pairs:
+            # Colour catches straight copies, layout catches the same poster recoloured
+            for i, j in zip(*np.nonzero(np.triu((sims > img_thresh) | (layouts > layout_thresh), 1))):
+                p1, p2 = keys[i], keys[j]
                 d1, d2 = images[p1], images[p2]
-                sim = cv2.compareHist(d1['hist'], d2['hist'], cv2.HISTCMP_CORREL) * 100
-                if sim > img_thresh:
-                    found = True
-                    st.markdown(f"""
-                    <div class="report-card">
-                        <h4>🎨 Visual Match: {sim:.1f}%</h4>
-                        <span class="student-tag">{p1}</span> vs <span class="student-tag">{p2}</span>
-                    </div>""", unsafe_allow_html=True)
-                    col1, col2 = st.columns(2)
-                    col1.image(d1['obj'], caption=p1, width=200)
-                    col2.image(d2['obj'], caption=p2, width=200)
+                sim, layout = sims[i, j], layouts[i, j]
+                found = True
+                title = f"🎨 Visual Match: {sim:.1f}%" if sim > img_thresh else f"📐 Layout Match: {layout:.1f}%"
+                st.markdown(f"""
+                <div class="report-card">
+                    <h4>{title}</h4>
+                    <span class="student-tag">{p1}</span> vs <span class="student-tag">{p2}</span>
+                    <br><br><b>Colour Match:</b> {sim:.1f}%
+                    <br><b>Layout Match:</b> {layout:.1f}%
+                </div>""", unsafe_allow_html=True)
+                col1, col2 = st.columns(2)
+                col1.image(read_image(d1['src']), caption=p1, width=200)
+                col2.image(read_image(d2['src']), caption=p2, width=200)
             if not found: st.success("✅ No poster plagiarism detected.")
 
     # --- TAB 3: VIDEOS ---
     with tab3:
         if len(videos) < 2: st.info("Needs 2+ videos.")
         else:
-            pairs = list(combinations(videos.keys(), 2))
+            keys = list(videos.keys())
+            groups = {}
+            for i, k in enumerate(keys): groups.setdefault(videos[k]['hash'], []).append(i)
             found = False
-            for p1, p2 in pairs:
-                d1, d2 = videos[p1], videos[p2]
-                if d1['hash'] == d2['hash']:
-                    found = True
-                    st.markdown(f"""
-                    <div class="report-card">
-                        <h4>🎥 Duplicate Video File</h4>
-                        <span class="student-tag">{p1}</span> == <span class="student-tag">{p2}</span>
-                    </div>""", unsafe_allow_html=True)
+            for g in groups.values():
+                for a in range(len(g)):
+                    for b in range(a + 1, len(g)):
+                        found = True
+                        st.markdown(f"""
+                        <div class="report-card">
+                            <h4>🎥 Duplicate Video File</h4>
+                            <span class="student-tag">{keys[g[a]]}</span> == <span class="student-tag">{keys[g[b]]}</span>
+                        </div>""", unsafe_allow_html=True)
             if not found: st.success("✅ No video duplicates found.")
+
+else:
+    # Nothing uploaded any more: let go of the last set's records and the uploads they point into
+    st.session_state.pop('ingested', None)
+    st.session_state.pop('upload_ids', None)